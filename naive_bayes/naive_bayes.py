@@ -1,7 +1,53 @@
-from __future__ import division
-from collections import Counter, defaultdict
+from collections import Counter
 import numpy as np
 import itertools
+from scipy.sparse import csr_matrix
+
+try:
+    from numba import get_num_threads, njit, prange
+except ImportError:
+    njit = None
+
+# Most memory the numba kernel may use for its per-thread count buffers
+_COUNT_BUFFER_BYTES = 2 ** 26
+
+
+if njit is None:
+    _count_features = None
+else:
+    @njit(parallel=True)
+    def _count_features(tokens, offsets, labels, n_classes, p, n_chunks):
+        '''
+        INPUT:
+        - tokens: numpy int32 array, vocab id of every token in the corpus
+        - offsets: numpy int64 array, document i spans
+                   tokens[offsets[i]:offsets[i + 1]]
+        - labels: numpy int array, class row of each document
+        - n_classes: int, number of classes
+        - p: int, number of features
+        - n_chunks: int, number of chunks to split the documents into
+
+        OUTPUT:
+        - counts: numpy int32 array of feature counts per class; shape (C, p)
+
+        Each chunk of documents counts into its own buffer, so threads never
+        write to the same cell.
+        '''
+        n_docs = len(labels)
+        partial = np.zeros((n_chunks, n_classes, p), dtype=np.int32)
+        for k in prange(n_chunks):
+            start = k * n_docs // n_chunks
+            stop = (k + 1) * n_docs // n_chunks
+            for i in range(start, stop):
+                c = labels[i]
+                for j in range(offsets[i], offsets[i + 1]):
+                    partial[k, c, tokens[j]] += 1
+
+        counts = partial[0]
+        for k in range(1, n_chunks):
+            counts += partial[k]
+        return counts
+
 
 class NaiveBayes(object):
     def __init__(self, alpha=1.):
@@ -11,37 +57,87 @@ class NaiveBayes(object):
         -alpha: float, laplace smoothing constant.
 
         ATTRIBUTES:
-        - class_counts: the number of samples per class; keys=labels
-        - class_feature_counts: the number of samples per feature per label;
-                               keys=labels, values=Counter with key=feature
+        - classes_: numpy array of the sorted labels; row order of the counts
+        - class_totals: the number of words per class; shape (C,)
+        - feat_counts: the number of occurrences of each feature per class;
+                       shape (C, p), columns indexed by vocab
         - class_freq: the frequency of each class in the data
         - p: the number of features
+        - vocab: dictionary mapping each feature to its column id
+        - log_likelihood: log(p(feature|label)) with laplace smoothing;
+                          shape (C, p)
+        - log_prior: log(p(label)); shape (C,)
         '''
 
-        self.class_counts = defaultdict(int)
-        self.class_feature_counts = defaultdict(Counter)
+        self.classes_ = None
+        self.class_totals = None
+        self.feat_counts = None
         self.class_freq = None
         self.alpha = float(alpha)
         self.p = None
+        self.vocab = None
+        self.log_likelihood = None
+        self.log_prior = None
 
-    def _compute_likelihoods(self, X, y):
+    def _doc_term(self, tokens, lengths, dtype=np.float32):
         '''
         INPUT:
-        - X: List of tokens
+        - tokens: numpy int32 array, vocab id of every token in the corpus
+        - lengths: numpy int64 array, number of tokens in each document
+        - dtype: numpy dtype of the counts
+
+        OUTPUT:
+        - doc_term: sparse matrix of feature counts; shape (len(lengths), p)
+        '''
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        return csr_matrix((np.ones(len(tokens), dtype=dtype),
+                           tokens, indptr), shape=(len(lengths), self.p))
+
+    def _compute_likelihoods(self, tokens, lengths, y):
+        '''
+        INPUT:
+        - tokens: numpy int32 array, vocab id of every token in the corpus
+        - lengths: numpy int64 array, number of tokens in each document
         - y: numpy array, labels
 
         Compute the word count for each class and the frequency of each feature
-        per class.  (Compute class_counts and class_feature_counts).
+        per class, and the smoothed log likelihoods they give.  (Compute
+        class_totals, feat_counts and log_likelihood).
         '''
 
-        for idx,c in enumerate(y): # for each unique class, add # of words in each article
-            if c in self.class_counts:
-                self.class_counts[c] += len(X[idx])
-            else:
-                self.class_counts[c] = len(X[idx])
-
-        for k in self.class_counts: # add alpha * num words in vocab to each class count
-            self.class_counts[k] += self.p * self.alpha
+        self.classes_, labels = np.unique(y, return_inverse=True)
+        n_classes = len(self.classes_)
+
+        # Word count per class: label of each token, counted in a single pass
+        self.class_totals = np.bincount(np.repeat(labels, lengths),
+                                        minlength=n_classes).astype(np.float32)
+
+        # Feature counts per class: compiled loop over the tokens if numba is
+        # installed, otherwise (classes x docs) . (docs x vocab). Both count in
+        # integers, since float32 stops counting exactly at 2**24
+        if _count_features is not None:
+            # one (C, p) buffer per thread, but only as many as fit in
+            # _COUNT_BUFFER_BYTES, so a large vocabulary is not multiplied by
+            # the number of threads
+            n_chunks = min(get_num_threads(), _COUNT_BUFFER_BYTES //
+                           max(4 * n_classes * self.p, 1))
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            self.feat_counts = _count_features(
+                tokens, offsets, labels, n_classes, self.p,
+                max(n_chunks, 1)).astype(np.float32)
+        else:
+            n = len(lengths)
+            doc_term = self._doc_term(tokens, lengths, dtype=np.int64)
+            onehot = csr_matrix((np.ones(n, dtype=np.int64), labels,
+                                 np.arange(n + 1)), shape=(n, n_classes))
+            self.feat_counts = (onehot.T @ doc_term).toarray().astype(
+                np.float32)
+
+        # log((count + alpha) / (class total + alpha * p)), once for all docs
+        smoothed = ((self.feat_counts.astype(np.float64) + self.alpha) /
+                    (self.class_totals.astype(np.float64) +
+                     self.alpha * self.p)[:, np.newaxis])
+        self.log_likelihood = np.log(smoothed)
 
     def fit(self, X, y):
         '''
@@ -54,11 +150,24 @@ class NaiveBayes(object):
         # Compute class frequency P(y)
         self.class_freq = Counter(y)
 
+        # Build the vocabulary and map every token to its id in the same pass
+        vocab = {}
+        tokens = np.fromiter((vocab.setdefault(t, len(vocab))
+                              for t in itertools.chain(*X)), dtype=np.int32)
+        lengths = np.fromiter((len(doc) for doc in X), dtype=np.int64,
+                              count=len(X))
+
         # Compute number of features
-        self.p = len(set(itertools.chain(*X)))
+        self.vocab = vocab
+        self.p = len(vocab)
 
         # Compute likelihoods
-        self._compute_likelihoods(X, y)
+        self._compute_likelihoods(tokens, lengths, y)
+
+        # Compute log class prior, in the same order as the likelihood rows
+        freq = np.array([self.class_freq[c] for c in self.classes_],
+                        dtype=np.float64)
+        self.log_prior = np.log(freq / freq.sum())
 
     def posteriors(self, X):
         '''
@@ -66,9 +175,19 @@ class NaiveBayes(object):
         - X: List of list of tokens.
 
         OUTPUT:
-        List of dictionaries with key=label, value=log(p(label|X))
+        numpy array of shape (len(X), C) with value=log(p(label|X)), up to a
+        constant per document; columns follow classes_
         '''
-        pass
+        # Features not seen during fit carry no information, so drop them
+        docs = [[self.vocab[t] for t in doc if t in self.vocab] for doc in X]
+        lengths = np.fromiter((len(doc) for doc in docs), dtype=np.int64,
+                              count=len(docs))
+        tokens = np.fromiter(itertools.chain(*docs), dtype=np.int32,
+                             count=lengths.sum())
+
+        scores = self._doc_term(tokens, lengths) @ self.log_likelihood.T
+        scores += self.log_prior
+        return scores
 
     def predict(self, X):
         """
@@ -79,11 +198,7 @@ class NaiveBayes(object):
         - predictions: a numpy array with predicted labels.
 
         """
-        predictions = []
-        for post in self.posteriors(X):
-            pred = max(post.iterkeys(), key=(lambda label: post[label]))
-            predictions.append(pred)
-        return np.array(predictions)
+        return self.classes_[np.argmax(self.posteriors(X), axis=1)]
 
     def score(self, X, y):
         '''
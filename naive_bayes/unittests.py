@@ -5,6 +5,7 @@ Usage: from main nlp directory run: make test
 
 import unittest as unittest
 import numpy as np
+from src import naive_bayes
 from src.naive_bayes import NaiveBayes
 
 def laplace(n, d, p):
@@ -26,20 +27,25 @@ class TestNaiveBayes(unittest.TestCase):
         self.y = None
         self.nb = None
 
+    def _row(self, label):
+        return list(self.nb.classes_).index(label)
+
     def test_class_freq(self):
         self.assertEqual(self.nb.class_freq['fishing'], 2)
         self.assertEqual(self.nb.class_freq['knot-tying'], 1)
 
-    def test_class_counts(self):
-        self.assertEqual(self.nb.class_counts['fishing'], 9)
+    def test_class_totals(self):
+        self.assertEqual(self.nb.class_totals[self._row('fishing')], 9)
 
     def test_p_is_number_features(self):
         self.assertEqual(self.nb.p, 8)
 
-    def test_class_feature_counts(self):
-        self.assertEqual(self.nb.class_feature_counts['knot-tying']['fishing'], 0)
-        self.assertEqual(self.nb.class_feature_counts['fishing']['document'], 1)
-        self.assertEqual(self.nb.class_feature_counts['fishing']['fishing'], 2)
+    def test_feat_counts(self):
+        counts, vocab = self.nb.feat_counts, self.nb.vocab
+        self.assertEqual(counts.shape, (2, 8))
+        self.assertEqual(counts[self._row('knot-tying'), vocab['fishing']], 0)
+        self.assertEqual(counts[self._row('fishing'), vocab['document']], 1)
+        self.assertEqual(counts[self._row('fishing'), vocab['fishing']], 2)
 
     def test_predict(self):
         test_X = [["book"]]
@@ -49,11 +55,40 @@ class TestNaiveBayes(unittest.TestCase):
         posts = self.nb.posteriors(test_X)
         preds = self.nb.predict(test_X)
 
-        self.assertEqual(fishing_likelihood, posts[0]['fishing'])
-        self.assertEqual(knot_tying_likelihood, posts[0]['knot-tying'])
+        self.assertEqual(fishing_likelihood, posts[0, self._row('fishing')])
+        self.assertEqual(knot_tying_likelihood,
+                         posts[0, self._row('knot-tying')])
         self.assertEqual(preds[0], 'fishing')
         self.assertNotEqual(preds[0], 'knot-tying')
 
+    def test_posteriors_unknown_feature(self):
+        posts = self.nb.posteriors([["salmon"], []])
+        log_prior = np.log([2/3., 1/3.])
+        np.testing.assert_allclose(posts, [log_prior, log_prior])
+
+    def test_sparse_counts_match_kernel(self):
+        # the scipy fallback used without numba must agree with the kernel
+        rng = np.random.RandomState(0)
+        X = [[str(t) for t in rng.randint(0, 50, rng.randint(0, 30))]
+             for _ in range(200)]
+        y = rng.randint(0, 3, 200)
+        X_test = X[:20] + [['unseen']]
+
+        nb = NaiveBayes()
+        nb.fit(X, y)
+        kernel = naive_bayes._count_features
+        naive_bayes._count_features = None
+        try:
+            nb_sparse = NaiveBayes()
+            nb_sparse.fit(X, y)
+        finally:
+            naive_bayes._count_features = kernel
+
+        np.testing.assert_array_equal(nb_sparse.feat_counts, nb.feat_counts)
+        np.testing.assert_array_equal(nb_sparse.class_totals, nb.class_totals)
+        np.testing.assert_allclose(nb_sparse.posteriors(X_test),
+                                   nb.posteriors(X_test))
+
     def test_score(self):
         self.assertEqual(self.nb.score(self.X, self.y), 1.)
 
@@ -1,8 +1,31 @@
-from __future__ import print_function
+import os
+import queue
+import threading
+import warnings
 
 import numpy as np
 import matplotlib.pyplot as plt
-from past.builtins import xrange
+
+# Set NEURAL_NET_GPU=1 to run TwoLayerNet on the GPU through CuPy, which has
+# the same API as numpy but keeps the arrays and matrix products on the device
+xp = np
+if os.environ.get('NEURAL_NET_GPU') == '1':
+  try:
+    import cupy
+    cupy.cuda.runtime.getDeviceCount() # raises if there is no usable CUDA device or driver
+    xp = cupy
+  except Exception as e:
+    warnings.warn('NEURAL_NET_GPU is set but CuPy is unusable (%s); using numpy' % e)
+
+
+def _asnumpy(a):
+  """
+  Copy an xp array back to the host as a numpy array; a no-op when running on numpy.
+  """
+  if xp is np:
+    return a
+  return xp.asnumpy(a)
+
 
 class TwoLayerNet(object):
   """
@@ -17,13 +40,20 @@ class TwoLayerNet(object):
   input - fully connected layer - ReLU - fully connected layer - softmax
 
   The outputs of the second fully-connected layer are the scores for each class.
+
+  If the NEURAL_NET_GPU environment variable is set to 1 and CuPy can use a
+  CUDA device, the parameters are kept on the GPU and all of the work in loss()
+  runs there; inputs may still be passed as numpy arrays, and predict returns a
+  numpy array. Otherwise everything is plain numpy.
   """
 
   def __init__(self, input_size, hidden_size, output_size, std=1e-4):
     """
     Initialize the model. Weights are initialized to small random values and
     biases are initialized to zero. Weights and biases are stored in the
-    variable self.params, which is a dictionary with the following keys:
+    variable self.params, which is a dictionary with the following keys (all
+    float32, which halves memory traffic and doubles the SIMD width of the
+    matrix products compared to float64):
 
     W1: First layer weights; has shape (D, H)
     b1: First layer biases; has shape (H,)
@@ -36,10 +66,28 @@ class TwoLayerNet(object):
     - output_size: The number of classes C.
     """
     self.params = {}
-    self.params['W1'] = std * np.random.randn(input_size, hidden_size)
-    self.params['b1'] = np.zeros(hidden_size)
-    self.params['W2'] = std * np.random.randn(hidden_size, output_size)
-    self.params['b2'] = np.zeros(output_size)
+    self.params['W1'] = xp.asarray((std * np.random.randn(input_size, hidden_size)).astype(np.float32))
+    self.params['b1'] = xp.zeros(hidden_size, dtype=xp.float32)
+    self.params['W2'] = xp.asarray((std * np.random.randn(hidden_size, output_size)).astype(np.float32))
+    self.params['b2'] = xp.zeros(output_size, dtype=xp.float32)
+
+    # Weight gradients are written into these on every call to loss, so a
+    # training step does not allocate new (D,H) and (H,C) arrays. loss
+    # reallocates them if weights of another shape or dtype are assigned
+    self._buf = {}
+    self._buf['W1'] = xp.empty_like(self.params['W1'])
+    self._buf['W2'] = xp.empty_like(self.params['W2'])
+
+  def _grad_buffer(self, name, shape, dtype):
+    """
+    Return the gradient buffer stored under name, replacing it with a new one
+    if it does not have the given shape and dtype (e.g. after new weights were
+    assigned to self.params).
+    """
+    buf = self._buf.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+      buf = self._buf[name] = xp.empty(shape, dtype=dtype)
+    return buf
 
   def loss(self, X, y=None, reg=0.0):
     """
@@ -63,10 +111,13 @@ class TwoLayerNet(object):
       samples.
     - grads: Dictionary mapping parameter names to gradients of those parameters
       with respect to the loss function; has the same keys as self.params.
+      grads['W1'] and grads['W2'] are buffers owned by the network and are
+      overwritten by the next call, so copy them if they need to be kept.
     """
     # Unpack variables from the params dictionary
     W1, b1 = self.params['W1'], self.params['b1']
     W2, b2 = self.params['W2'], self.params['b2']
+    X = xp.ascontiguousarray(xp.asarray(X, dtype=xp.float32)) # match the float32 params so the products stay in single precision (and copy to the GPU if running on CuPy)
     N, D = X.shape
 
     # Compute the forward pass
@@ -77,9 +128,12 @@ class TwoLayerNet(object):
     # shape (N, C).                                                             #
     #############################################################################
 
-    h1 = np.maximum(0, X.dot(W1) + b1) # f(X, W1, b1). should be of shape (N,H) = (N,D) * (D,H) so: X.dot(W1) + b1. use ReLU, take the max
+    h1 = X.dot(W1) # f(X, W1, b1). should be of shape (N,H) = (N,D) * (D,H) so: X.dot(W1) + b1. use ReLU, take the max
+    xp.add(h1, b1, out=h1) # bias and ReLU are applied in place on the matmul result, so no extra (N,H) temporaries
+    xp.maximum(h1, 0, out=h1)
 
-    scores = h1.dot(W2) + b2 #f(h1, W2, B2). should be of shape (N,C) = (N,H) * (H,C) = h1 * W2
+    scores = h1.dot(W2) #f(h1, W2, B2). should be of shape (N,C) = (N,H) * (H,C) = h1 * W2
+    xp.add(scores, b2, out=scores)
 
     # If the targets are not given then jump out, we're done
     # we're just using the weights and input data to calculate the loss
@@ -87,20 +141,27 @@ class TwoLayerNet(object):
     if y is None:
       return scores
 
+    y = xp.asarray(y)
+    relu_mask = h1 > 0 # which hidden units fired; reused to backprop through the ReLU
+
     # Compute the loss
 
     #compute class probabilities
-    exp_scores = np.exp(scores) # cleanly takes care of the e^ step in softmax formula
-    probabilities = exp_scores / np.sum(exp_scores, axis=1, keepdims=True) # N x K, gives a score for each class for each observation
+    scores -= scores.max(axis=1, keepdims=True) # shift each row so its max is 0; softmax is unchanged but e^score can no longer overflow
+    idx = xp.arange(N) # row index of every observation, shared by the loss and its gradient
+    correct_scores = scores[idx, y] # pull the correct class scores out before scores is overwritten below
+    probabilities = xp.exp(scores, out=scores) # e^score written over scores: this one (N,C) buffer becomes the probabilities, then dscores
+    sum_exp = probabilities.sum(axis=1)
+    logZ = xp.log(sum_exp) # log of the softmax denominator for each observation (logsumexp)
+    probabilities /= sum_exp[:, None] # N x K, gives a score for each class for each observation. only needed for the backward pass
 
     #compute avg cross-entropy loss (data loss)& regularization
-    neg_logprobs = -np.log(probabilities[range(N),y]) # gets log probabilities of all the correct classes by pulling probs in rows 0-N & column y for each row (column of correct class)
-    data_loss = np.sum(neg_logprobs) / N # average negative log probability of each correct class, to minimize
+    data_loss = (logZ - correct_scores).mean() # -log(e^correct score / sum) = logZ - correct score, averaged over observations, to minimize
 
-    reg_loss = 0.5 * reg * np.sum(W1 ** 2) + .5 * reg * np.sum(W2 ** 2) # dividing the reg loss between the weight sets
+    reg_loss = 0.5 * reg * (xp.einsum('ij,ij->', W1, W1) + xp.einsum('ij,ij->', W2, W2)) # dividing the reg loss between the weight sets. einsum sums the squares without building W**2
     loss = data_loss + reg_loss
 
-    # Softmax: L_i = -log(e^score of correct class / sum of all scores)
+    # Softmax: L_i = -log(e^score of correct class / sum of all scores) = logZ_i - score of correct class, so no log of the probabilities is taken
     # we want to minimize the loss, i.e. minimize the negative log likelihood of the correct class
     # include L2 regularization
 
@@ -115,18 +176,25 @@ class TwoLayerNet(object):
     # Backward pass: compute gradients
     grads = {}
 
+    # row of N ones: summing a gradient over the batch is ones.dot(grad), a
+    # BLAS matrix-vector product. kept between calls while the batch size holds
+    ones = self._buf.get('ones')
+    if ones is None or ones.shape[0] != N:
+      ones = self._buf['ones'] = xp.ones(N, dtype=xp.float32)
+
     # df/df = 1
     # dW2/df = derivative of Softmax w.r.t. W2 . do this numerically or analytically
 
     # compute the gradient on scores
 
-    dscores = probabilities
-    dscores[range(N),y]  -= 1
+    dscores = probabilities # alias, not a copy: the gradient is built in place in the probabilities buffer
+    dscores[idx,y]  -= 1
     dscores /= N # subtracting 1 from each correct score, and taking the average. increasing scores increases loss by a little bit, except if the score is of the correct class (so subtract 1 --> it'll get zeroed out?)
 
     # gradient on W2 and b2
 
-    grads['W2'] = np.dot(h1.T, dscores) # partial derivative (gradient) w.r.t. W2 (dW2/dscores), i.e. how does a change in W2 affect scores. should have same shape as W2, i.e. (H,C)
+    dW2 = self._grad_buffer('W2', W2.shape, xp.result_type(h1, dscores))
+    grads['W2'] = xp.dot(h1.T, dscores, out=dW2) # partial derivative (gradient) w.r.t. W2 (dW2/dscores), i.e. how does a change in W2 affect scores. should have same shape as W2, i.e. (H,C)
     # h1 = (N,H), b1 = (H,), W2 = (H,C) --> (N,C)
     # dh1 / df * df / df = dh1 / df
     # so dh1/dscores * dscores/dscores = dh1/dscores
@@ -134,15 +202,15 @@ class TwoLayerNet(object):
     # --> h1.T * dscores = (H,C)
     # do the transpose bc you're doing the operation backwards from forward propagation, solving for a W2-shaped matrix to multiply h1 by to get a shift in scores
 
-    grads['b2'] = np.sum(dscores, axis=0) # partial derivative w.r.t. bias term, db2/dscores. sums columns of dscores, multiplied by a column vector (many rows) of constants (b2)
+    grads['b2'] = ones.dot(dscores) # partial derivative w.r.t. bias term, db2/dscores. sums columns of dscores, multiplied by a column vector (many rows) of constants (b2)
 
     # backprop into hidden layer, get partial derivative: dhidden / dscores
     # dhidden = (N,H). W2 = (H,C), dscores = (N,C)
     # --> do dscores * W2.T
-    dhidden = np.dot(dscores,W2.T)
+    dhidden = xp.dot(dscores,W2.T)
 
     # backprop the ReLU non-linearity by zeroing dhidden elements at indices where h1 <= 0
-    dhidden[h1 <= 0] = 0
+    xp.multiply(dhidden, relu_mask, out=dhidden)
 
     # now, backprop into W1,b1
 
@@ -151,10 +219,11 @@ class TwoLayerNet(object):
     # dhidden = (N,H)
     # dW1 / dhidden = X.T * dhidden
 
-    grads['W1'] = np.dot(X.T, dhidden)
+    dW1 = self._grad_buffer('W1', W1.shape, xp.result_type(X, dhidden))
+    grads['W1'] = xp.dot(X.T, dhidden, out=dW1)
 
     # db1/dhidden = impact of each value in b1 magnified by sum of corresponding row
-    grads['b1'] = np.sum(dhidden,axis=0)
+    grads['b1'] = ones.dot(dhidden)
 
     # add regularization gradient contrib
     grads['W2'] += reg *  W2
@@ -170,6 +239,68 @@ class TwoLayerNet(object):
 
     return loss, grads
 
+  def _minibatches(self, X, y, batch_size, num_iters, depth=2):
+    """
+    Yield num_iters random minibatches (X_batch, y_batch) of X and y. A
+    background thread samples and gathers the next batches while the caller
+    is computing on the current one; numpy releases the GIL while copying, so
+    the gather overlaps with the forward and backward pass.
+
+    Batches are written into a fixed set of float32 buffers that are reused,
+    so a yielded batch is only valid until the next one is requested. Being
+    float32 like the parameters, the batches are not copied again by loss();
+    pass a float32 X to also avoid converting while gathering.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) giving training data.
+    - y: A numpy array of shape (N,) giving training labels.
+    - batch_size: Number of training examples per minibatch.
+    - num_iters: Number of minibatches to produce.
+    - depth: Number of gathered minibatches to keep ready ahead of the caller.
+    """
+    num_train = X.shape[0]
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    # one buffer being filled, up to depth waiting in the queue and one held by
+    # the caller, so the producer never overwrites a batch that is still in use
+    buffers = [(np.empty((batch_size,) + X.shape[1:], dtype=np.float32),
+                np.empty(batch_size, dtype=y.dtype)) for _ in range(depth + 2)]
+
+    def put(item):
+      # give up if the caller has stopped consuming, rather than block forever
+      while not stop.is_set():
+        try:
+          batches.put(item, timeout=0.1)
+          return True
+        except queue.Full:
+          pass
+      return False
+
+    def produce():
+      try:
+        for it in range(num_iters):
+          X_buf, y_buf = buffers[it % len(buffers)]
+          sample_indices = np.random.randint(num_train, size=batch_size) # sample with replacement, without building an arange of all N indices
+          np.take(X, sample_indices, axis=0, out=X_buf, mode='clip') # indices come from randint so are always in range; 'clip' skips the bounds check of fancy indexing
+          np.take(y, sample_indices, out=y_buf, mode='clip')
+          if not put((X_buf, y_buf)):
+            return
+      except Exception as e:
+        put(e) # re-raised in the caller's thread
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+      for _ in range(num_iters):
+        batch = batches.get()
+        if isinstance(batch, Exception):
+          raise batch
+        yield batch
+    finally:
+      stop.set()
+
   def train(self, X, y, X_val, y_val,
             learning_rate=1e-3, learning_rate_decay=0.95,
             reg=5e-6, num_iters=100,
@@ -191,15 +322,19 @@ class TwoLayerNet(object):
     - batch_size: Number of training examples to use per step.
     - verbose: boolean; if true print progress during optimization.
     """
+    X = np.asarray(X, dtype=np.float32) # cast the training data once, so neither the minibatch gather nor loss() has to convert each batch
     num_train = X.shape[0]
-    iterations_per_epoch = max(num_train / batch_size, 1)
+    iterations_per_epoch = max(num_train // batch_size, 1)
 
     # Use SGD to optimize the parameters in self.model
     loss_history = []
     train_acc_history = []
     val_acc_history = []
 
-    for it in xrange(num_iters):
+    # X and y stay host numpy arrays; loss moves each minibatch to the GPU when running on CuPy
+    batches = self._minibatches(X, y, batch_size, num_iters)
+
+    for it in range(num_iters):
       X_batch = None
       y_batch = None
 
@@ -207,9 +342,7 @@ class TwoLayerNet(object):
       # TODO: Create a random minibatch of training data and labels, storing  #
       # them in X_batch and y_batch respectively.                             #
       #########################################################################
-      sample_indices = np.random.choice(np.arange(num_train),batch_size)
-      X_batch = X[sample_indices]
-      y_batch = y[sample_indices]
+      X_batch, y_batch = next(batches) # gathered in the background while the previous step was computing
 
       #########################################################################
       #                             END OF YOUR CODE                          #
@@ -217,7 +350,7 @@ class TwoLayerNet(object):
 
       # Compute loss and gradients using the current minibatch
       loss, grads = self.loss(X_batch, y=y_batch, reg=reg)
-      loss_history.append(loss)
+      loss_history.append(float(loss))
 
       #########################################################################
       # TODO: Use the gradients in the grads dictionary to update the         #
@@ -225,10 +358,9 @@ class TwoLayerNet(object):
       # using stochastic gradient descent. You'll need to use the gradients   #
       # stored in the grads dictionary defined above.                         #
       #########################################################################
-      self.params['W1'] += -learning_rate * grads['W1']
-      self.params['b1'] += -learning_rate * grads['b1']
-      self.params['W2'] += -learning_rate * grads['W2']
-      self.params['b2'] += -learning_rate * grads['b2']
+      for p in ('W1', 'b1', 'W2', 'b2'):
+        xp.multiply(grads[p], learning_rate, out=grads[p]) # scale the gradient in place instead of allocating -learning_rate * grads[p]
+        self.params[p] -= grads[p]
 
       #########################################################################
       #                             END OF YOUR CODE                          #
@@ -269,10 +401,6 @@ class TwoLayerNet(object):
       the elements of X. For all i, y_pred[i] = c means that X[i] is predicted
       to have class c, where 0 <= c < C.
     """
-    y_pred = None
-
-    h1 = np.maximum(X.dot(self.params['X1']) + self.params['b1'],0) # hidden layer passed through ReLU
-    scores = h1.dot(self.params['W2']) + self.params['b2']
-    y_pred = np.argmax(scores,axis=1) # returns the index with the highest score for each test row
+    y_pred = _asnumpy(xp.argmax(self.loss(X), axis=1)) # returns the index with the highest score for each test row; loss without y is the forward pass
 
     return y_pred
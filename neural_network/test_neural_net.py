@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+import neural_net
+from neural_net import TwoLayerNet
+
+
+def fake_data():
+    # row i of X starts with i and y[i] = i, so a batch can be checked
+    # against its own labels
+    X = np.arange(60, dtype=np.float64).reshape(20, 3)
+    X[:, 0] = np.arange(20)
+    y = np.arange(20)
+    return X, y
+
+
+def reference_loss(params, X, y, reg):
+    # straightforward float64 forward and backward pass to check loss against
+    W1, b1 = params['W1'], params['b1']
+    W2, b2 = params['W2'], params['b2']
+    N = X.shape[0]
+    h1 = np.maximum(0, X.dot(W1) + b1)
+    scores = h1.dot(W2) + b2
+    exp_scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+    probs = exp_scores / exp_scores.sum(axis=1, keepdims=True)
+    loss = (-np.log(probs[range(N), y]).mean() +
+            0.5 * reg * (np.sum(W1 ** 2) + np.sum(W2 ** 2)))
+
+    dscores = probs.copy()
+    dscores[range(N), y] -= 1
+    dscores /= N
+    dhidden = dscores.dot(W2.T)
+    dhidden[h1 <= 0] = 0
+    grads = {'W1': X.T.dot(dhidden) + reg * W1, 'b1': dhidden.sum(axis=0),
+             'W2': h1.T.dot(dscores) + reg * W2, 'b2': dscores.sum(axis=0)}
+    return loss, grads
+
+
+def check_loss_against_reference(scale):
+    np.random.seed(0)
+    net = TwoLayerNet(4, 10, 3, std=1e-1)
+    net.params['b1'] += np.float32(0.1)
+    net.params['b2'] += np.float32(0.2)
+    X = scale * np.random.randn(5, 4)
+    y = np.array([0, 1, 2, 2, 1])
+    params = dict((k, v.astype(np.float64)) for k, v in net.params.items())
+
+    scores = net.loss(X)
+    loss, grads = net.loss(X, y, reg=0.05)
+    expected_loss, expected_grads = reference_loss(params, X, y, 0.05)
+
+    assert np.isfinite(loss)
+    np.testing.assert_allclose(loss, expected_loss, rtol=1e-5)
+    for name in ('W1', 'b1', 'W2', 'b2'):
+        assert np.all(np.isfinite(grads[name]))
+        np.testing.assert_allclose(grads[name], expected_grads[name],
+                                   rtol=1e-4, atol=1e-6)
+    return scores
+
+
+def test_loss_matches_float64_reference():
+    check_loss_against_reference(10)
+
+
+def test_loss_large_logits():
+    # scores this large overflow exp in float32 unless the max is subtracted
+    scores = check_loss_against_reference(1e4)
+    assert np.abs(scores).max() > 1e3
+
+
+def test_minibatches_match_sequential_sampling():
+    X, y = fake_data()
+    net = TwoLayerNet(3, 5, 20)
+    np.random.seed(0)
+    batches = [(X_batch.copy(), y_batch.copy())
+               for X_batch, y_batch in net._minibatches(X, y, 4, 10)]
+    np.random.seed(0)
+    for X_batch, y_batch in batches:
+        sample_indices = np.random.randint(len(X), size=4)
+        np.testing.assert_array_equal(X_batch, X[sample_indices])
+        np.testing.assert_array_equal(y_batch, y[sample_indices])
+
+
+def test_minibatches_held_batch_not_overwritten():
+    X, y = fake_data()
+    net = TwoLayerNet(3, 5, 20)
+    for X_batch, y_batch in net._minibatches(X, y, 4, 20):
+        expected = X_batch.copy(), y_batch.copy()
+        time.sleep(0.01)  # let the producer fill the queue and wait on it
+        np.testing.assert_array_equal(X_batch, expected[0])
+        np.testing.assert_array_equal(y_batch, expected[1])
+        np.testing.assert_array_equal(X_batch[:, 0], y_batch)
+
+
+def test_train_raises_producer_error():
+    X, y = fake_data()
+    net = TwoLayerNet(3, 5, 20)
+
+    def randint(*args, **kwargs):
+        raise ValueError('bad sample')
+
+    original = neural_net.np.random.randint
+    neural_net.np.random.randint = randint
+    try:
+        np.testing.assert_raises(ValueError, net.train, X, y, X, y,
+                                 num_iters=5, batch_size=4)
+    finally:
+        neural_net.np.random.randint = original